@@ -0,0 +1,67 @@
+# pylint: disable=line-too-long
+# pylint: disable=logging-format-interpolation
+"""
+Writes the feeds for tracked and popular manga out as static files for nginx to serve.
+
+    python export_feeds.py --root /var/www/CHANGEME/html
+    python export_feeds.py --root /var/www/CHANGEME/html --once --manga 12345 --manga <uuid>
+
+Runs forever by default, checking every --interval seconds and only rewriting
+files for manga whose chapters changed.
+"""
+import argparse
+import logging
+import time
+from lib.MDRSSFeed import MDRSSFeed
+from lib.FeedExporter import FeedExporter
+
+API_URL = "https://api.mangadex.org"
+
+def main():
+    parser = argparse.ArgumentParser(description="Export RSS/Atom feeds as static files")
+    parser.add_argument("--root", required=True, help="nginx document root to write the feeds into")
+    parser.add_argument("--top", type=int, default=100, help="Export this many of the most requested feeds (default: 100)")
+    parser.add_argument("--manga", action="append", default=[], help="Always export this manga ID, can be given more than once")
+    parser.add_argument("--track-file", help="File with manga IDs to always export, one per line")
+    parser.add_argument("--access-log", help="nginx access log, so feeds served from disk keep counting towards popularity")
+    parser.add_argument("--interval", type=int, default=300, help="Seconds between runs (default: 300)")
+    # The app and the exporter share the 5 calls/s API limit, 200 calls every 300s is about
+    # an eighth of it. Each manga takes up to 2 calls, so this covers --top 100 every run.
+    # Manga that don't fit get checked on the next runs.
+    parser.add_argument("--budget", type=int, default=200, help="Most uncached API calls to make per run (default: 200)")
+    parser.add_argument("--max-lag", type=int, default=900, help="Remove the files of manga that haven't been checked for this many seconds (default: 900)")
+    parser.add_argument("--decay", type=float, default=0.9, help="Multiply every feed's hit count by this after each run, so dead series drop out of the top (default: 0.9)")
+    parser.add_argument("--once", action="store_true", help="Run once and exit")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger('mdapi.export')
+    exporter = FeedExporter(MDRSSFeed(API_URL), args.root)
+
+    while True:
+        start = time.monotonic()
+        try:
+            tracked = list(args.manga)
+            if args.track_file:
+                with open(args.track_file) as track_file:
+                    tracked += [x.strip() for x in track_file if x.strip() and not x.startswith("#")]
+            if args.access_log:
+                exporter.read_access_log(args.access_log)
+            # Keep the order, tracked first, and don't do anything twice
+            manga_ids = list(dict.fromkeys(tracked + exporter.popular_manga(args.top)))
+            removed = exporter.prune(manga_ids)
+            written = exporter.export_all(manga_ids, budget=args.budget, tracked=tracked, max_lag=args.max_lag)
+            exporter.decay_hits(args.decay)
+            logger.info("Checked {} manga, wrote {}, removed {} in {:.1f}s".format(len(manga_ids), written, removed, time.monotonic() - start))
+        except Exception: # pylint: disable=broad-except
+            # Redis or the track file being unavailable for a bit shouldn't kill the daemon
+            if args.once:
+                raise
+            logger.exception("Export run failed, trying again in {}s".format(args.interval))
+        if args.once:
+            break
+        time.sleep(max(args.interval - (time.monotonic() - start), 0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# pylint: disable=line-too-long
+# pylint: disable=logging-format-interpolation
+# pylint: disable=missing-module-docstring
+import os
+import json
+import gzip
+import time
+import logging
+import tempfile
+from lib.rconn import get_cache, cache_nodes
+from lib.rcache import HITS_KEY, DistributedCache
+
+SNAPSHOT_VERSION = 1
+
+# Set on every cache node once it's been restored. If it's gone, redis was
+# flushed or restarted under us.
+SENTINEL_KEY = "cache_warm"
+
+class CacheSnapshot():
+    """
+    Saves the most requested cache entries to disk and puts them back into
+    Redis after it's been flushed or restarted, so we don't have to rebuild
+    every feed through the rate limit at once.
+    """
+    def __init__(self, api, path):
+        """
+        :param api: Instance whose cached make_request is used to refetch stale entries
+        :param str path: Where the snapshot lives
+        """
+        self.logger = logging.getLogger('mdapi.snapshot')
+        self.api = api
+        # Grab the DistributedCache itself rather than the bound method
+        self.cache = type(api).make_request
+        self.path = path
+        # Entries in the snapshot on disk, None until we've looked
+        self.last_size = None
+
+    @staticmethod
+    def wanted(args):
+        # Members counted before searches stopped being tracked can still be around
+        return DistributedCache.is_tracked(args)
+
+    def hot_entries(self, keep, page_size=1000):
+        """
+        Returns up to keep (args, kwargs, hits) for the most requested calls, most popular first
+        """
+        entries = []
+        for node in cache_nodes():
+            # Page through until this node has given us keep entries we actually
+            # want (or runs out), there may be old untracked members left over
+            found = 0
+            start = 0
+            while found < keep:
+                page = node.zrevrange(HITS_KEY, start, start + page_size - 1, withscores=True)
+                for member, hits in page:
+                    args, kwargs = self.cache.parse_member(member)
+                    if self.wanted(args) and found < keep:
+                        entries.append((args, kwargs, hits))
+                        found += 1
+                if len(page) < page_size:
+                    break
+                start += page_size
+        entries.sort(key=lambda x: x[2], reverse=True)
+        return entries[:keep]
+
+    def _pipelined(self, keys, command):
+        """
+        Runs command(pipe, key) for every key with one pipeline per node,
+        returns the replies keyed by cache key. command has to queue the same
+        number of commands for every key.
+        """
+        by_node = {}
+        for key in keys:
+            client = get_cache(key)
+            by_node.setdefault(id(client), (client, []))[1].append(key)
+        replies = {}
+        for client, node_keys in by_node.values():
+            pipe = client.pipeline(transaction=False)
+            for key in node_keys:
+                command(pipe, key)
+            results = pipe.execute()
+            per_key = len(results) // len(node_keys)
+            for index, key in enumerate(node_keys):
+                replies[key] = results[index * per_key:(index + 1) * per_key]
+        return replies
+
+    def is_flushed(self):
+        """
+        Whether any cache node lost everything since we last restored it
+        """
+        return any(not node.exists(SENTINEL_KEY) for node in cache_nodes())
+
+    def mark_warm(self):
+        for node in cache_nodes():
+            node.set(SENTINEL_KEY, time.time())
+
+    def load(self):
+        """
+        Returns the snapshot on disk, or None if there isn't a usable one
+        """
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            self.logger.warning("No snapshot at {}".format(self.path))
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            self.logger.warning("Snapshot {} is version {}, expected {}".format(self.path, snapshot.get("version"), SNAPSHOT_VERSION))
+            return None
+        self.last_size = len(snapshot["entries"])
+        return snapshot
+
+    def snapshot(self, keep=5000, force=False, min_ratio=0.5):
+        """
+        Write the hot entries and their values to disk. Returns how many were written.
+        Unless force is set, a snapshot with less than min_ratio of the entries of the
+        one on disk isn't written, redis has most likely just lost everything and the
+        old one is what we want to restore from.
+        """
+        entries = self.hot_entries(keep)
+        # Loading sets last_size
+        if self.last_size is None and self.load() is None:
+            self.last_size = 0
+        if not force and len(entries) < self.last_size * min_ratio:
+            self.logger.warning("Only found {} entries, the snapshot on disk has {}. Not overwriting it".format(len(entries), self.last_size))
+            return 0
+        keys = [self.cache.make_key(*args, **kwargs) for args, kwargs, _ in entries]
+        replies = self._pipelined(keys, lambda pipe, key: (pipe.get(key), pipe.ttl(key)))
+        snapshot = {"version": SNAPSHOT_VERSION, "taken": time.time(), "entries": []}
+        for (args, kwargs, hits), key in zip(entries, keys):
+            value, ttl = replies[key]
+            snapshot["entries"].append({
+                "args": args,
+                "kwargs": kwargs,
+                "hits": hits,
+                "ttl": ttl,
+                # Entries that already expired are kept so they get refetched
+                "value": json.loads(value) if value is not None else None,
+            })
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(handle, "wb") as raw_file, gzip.open(raw_file, "wt", encoding="utf-8") as tmp_file:
+                json.dump(snapshot, tmp_file, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.last_size = len(snapshot["entries"])
+        self.logger.info("Wrote {} entries to {}".format(len(snapshot["entries"]), self.path))
+        return len(snapshot["entries"])
+
+    def restore(self, grace=3600, max_age=21600):
+        """
+        Put the snapshot back into Redis. Anything already in Redis is left alone.
+        Entries that have gone stale since the snapshot are still served for up to
+        grace seconds, and returned (most popular first) so they can be refetched.
+        A snapshot older than max_age seconds is too far behind to serve from, only
+        its hit counts are restored and every entry is returned to be refetched.
+        """
+        snapshot = self.load()
+        if snapshot is None:
+            self.mark_warm()
+            return []
+
+        age = time.time() - snapshot["taken"]
+        too_old = age > max_age
+        if too_old:
+            self.logger.warning("Snapshot {} is {:.0f}s old, only restoring what's popular".format(self.path, age))
+        stale = []
+        by_key = {}
+        for entry in snapshot["entries"]:
+            entry["args"] = tuple(entry["args"])
+            if too_old:
+                entry["value"] = None
+            remaining = int(max(entry["ttl"], 0) - age)
+            if remaining <= 0:
+                stale.append(entry)
+                remaining = grace
+            by_key[self.cache.make_key(*entry["args"], **entry["kwargs"])] = (entry, remaining)
+
+        def restore_hits(pipe, key):
+            entry = by_key[key][0]
+            pipe.zadd(HITS_KEY, {self.cache.make_member(entry["args"], entry["kwargs"]): entry["hits"]}, nx=True)
+        def restore_value(pipe, key):
+            entry, remaining = by_key[key]
+            pipe.set(key, json.dumps(entry["value"]), ex=remaining, nx=True)
+        self._pipelined(list(by_key), restore_hits)
+        self._pipelined([x for x in by_key if by_key[x][0]["value"] is not None], restore_value)
+        self.mark_warm()
+        self.logger.info("Restored {} entries from {} ({:.0f}s old), {} are stale".format(len(by_key), self.path, age, len(stale)))
+        return stale
+
+    def refresh(self, entries, rate=1.0, stop=None):
+        """
+        Refetch entries from the API in the order given, at no more than rate calls
+        a second. Everything else shares the same 5 calls/s, and right after a flush
+        the app needs most of it for misses that weren't in the snapshot.
+        Stops early if the stop event gets set. Returns how many were refetched.
+        """
+        refreshed = 0
+        next_call = time.monotonic()
+        for index, entry in enumerate(entries, start=1):
+            if stop is not None and stop.is_set():
+                self.logger.info("Refresh stopped after {} of {} stale entries".format(index - 1, len(entries)))
+                break
+            key = self.cache.make_key(*entry["args"], **entry["kwargs"])
+            value = get_cache(key).get(key)
+            # Somebody asked for it since the restore and it's been fetched already
+            if value is not None and json.loads(value) != entry["value"]:
+                continue
+            wait = next_call - time.monotonic()
+            if wait > 0:
+                if stop is not None:
+                    stop.wait(wait)
+                else:
+                    time.sleep(wait)
+                if stop is not None and stop.is_set():
+                    continue
+            next_call = max(next_call, time.monotonic()) + 1.0 / rate
+            if self.cache.refresh(self.api, *entry["args"], **entry["kwargs"]) is not None:
+                refreshed += 1
+            if index % 100 == 0:
+                self.logger.info("Checked {} of {} stale entries".format(index, len(entries)))
+        self.logger.info("Refreshed {} stale entries".format(refreshed))
+        return refreshed
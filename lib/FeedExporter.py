@@ -0,0 +1,308 @@
+# pylint: disable=line-too-long
+# pylint: disable=logging-format-interpolation
+# pylint: disable=missing-module-docstring
+import os
+import re
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from uuid import UUID
+from lib.rconn import get_redis
+
+# Sorted set of manga ID -> number of times its feed was requested
+FEED_HITS_KEY = "feed_hits"
+
+FEED_TYPES = ("rss", "atom")
+
+# A feed nginx served from disk, in the default combined log format
+ACCESS_LOG_FEED = re.compile(r'"(?:GET|HEAD) /(?:rss|atom)/manga/([^ ?/"]+) HTTP/[^"]*" (?:200|304) ')
+
+# Seconds a worker holds on to feed hits before sending them to redis in one go
+HIT_FLUSH_INTERVAL = 10
+
+module_logger = logging.getLogger('mdapi.export')
+
+_HITS_LOCK = threading.Lock()
+_HITS = {}
+_LAST_FLUSH = time.monotonic()
+
+def record_feed_hit(manga_id):
+    """
+    Count a feed request, so the exporter knows what's popular. Counts are kept
+    here and sent every HIT_FLUSH_INTERVAL seconds, rather than costing every
+    feed a round trip to redis.
+    """
+    global _LAST_FLUSH # pylint: disable=global-statement
+    with _HITS_LOCK:
+        _HITS[str(manga_id)] = _HITS.get(str(manga_id), 0) + 1
+        if time.monotonic() - _LAST_FLUSH < HIT_FLUSH_INTERVAL:
+            return
+        hits = dict(_HITS)
+        _HITS.clear()
+        _LAST_FLUSH = time.monotonic()
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for hit_id, count in hits.items():
+            pipe.zincrby(FEED_HITS_KEY, count, hit_id)
+        pipe.execute()
+    except Exception as exc: # pylint: disable=broad-except
+        # Not worth failing the feed over
+        module_logger.warning("Failed to record {} feed hits: {}".format(sum(hits.values()), exc))
+
+def parse_manga_id(manga_id):
+    """
+    Turns a stored ID back into what the routes would have been given,
+    an int for legacy IDs or a UUID. Returns None if it's neither.
+    """
+    manga_id = str(manga_id)
+    if manga_id.isdigit():
+        return int(manga_id)
+    try:
+        return UUID(manga_id)
+    except ValueError:
+        return None
+
+class FeedExporter():
+    """
+    Writes RSS and Atom feeds out as plain files under the nginx root, at the
+    same paths the app serves them on (/rss/manga/<id>, /atom/manga/<id>),
+    so nginx can hand them out without ever asking the app.
+    Only the default (english) feed is written, anything with a ?lang= still
+    goes to the app.
+    """
+    def __init__(self, rss, root):
+        """
+        :param MDRSSFeed rss: Used to talk to the API and build the feeds
+        :param str root: The nginx document root
+        """
+        self.logger = logging.getLogger('mdapi.export')
+        self.rss = rss
+        self.root = root
+        # manga ID -> digest of the data the files on disk were built from
+        self.exported = {}
+        # manga ID -> when we last looked at it, so a budget gets round to everything eventually
+        self.last_checked = {}
+        self.started = time.time()
+        # legacy ID -> UUID, these never change
+        self.resolved = {}
+        # Where we got to in the nginx access log
+        self.log_inode = None
+        self.log_position = None
+
+    def popular_manga(self, limit):
+        """
+        Returns the IDs of the most requested feeds, most popular first
+        """
+        if limit <= 0:
+            return []
+        return get_redis().zrevrange(FEED_HITS_KEY, 0, limit - 1)
+
+    def decay_hits(self, factor, floor=0.1):
+        """
+        Scale every feed's hit count down by factor, so popular means popular
+        lately rather than ever. Anything that falls under floor is dropped.
+        """
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.zunionstore(FEED_HITS_KEY, {FEED_HITS_KEY: factor})
+        pipe.zremrangebyscore(FEED_HITS_KEY, "-inf", "({}".format(floor))
+        pipe.execute()
+
+    def files_on_disk(self):
+        """
+        Returns the IDs of every manga that has a feed file under the root,
+        including ones written before a restart
+        """
+        manga_ids = set()
+        for feedtype in FEED_TYPES:
+            try:
+                manga_ids.update(x for x in os.listdir(os.path.join(self.root, feedtype, "manga")) if not x.startswith(".tmp-"))
+            except FileNotFoundError:
+                pass
+        return manga_ids
+
+    def prune(self, keep_ids):
+        """
+        Remove the files for every manga not in keep_ids. Nobody would refresh them
+        anymore, so they have to go back to being served (and counted) by the app.
+        Returns how many were removed.
+        """
+        keep_ids = {str(x) for x in keep_ids}
+        removed = 0
+        for manga_id in self.files_on_disk() - keep_ids:
+            self.logger.info("{} isn't being exported anymore, removing its files".format(manga_id))
+            self.remove_files(manga_id)
+            removed += 1
+        return removed
+
+    def read_access_log(self, path):
+        """
+        Count the feeds nginx served from disk since the last call. Those never reach
+        the app, so without this they'd stop gaining hits and drop out of the top.
+        Returns how many hits were counted.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.logger.warning("Access log {} doesn't exist".format(path))
+            return 0
+        if self.log_position is None:
+            # Don't count what happened before we started, we'd count it again on every restart
+            self.log_inode, self.log_position = stat.st_ino, stat.st_size
+            return 0
+        if stat.st_ino != self.log_inode or stat.st_size < self.log_position:
+            # Rotated, start on the new one from the top
+            self.log_inode, self.log_position = stat.st_ino, 0
+
+        with open(path, "rb") as log_file:
+            log_file.seek(self.log_position)
+            data = log_file.read()
+        # Leave a half written last line for next time
+        data = data[:data.rfind(b"\n") + 1]
+        self.log_position += len(data)
+
+        # Misses are proxied to the app and show up here too, it counts those itself
+        on_disk = self.files_on_disk()
+        hits = {}
+        for line in data.decode("utf-8", errors="replace").splitlines():
+            matched = ACCESS_LOG_FEED.search(line)
+            if matched and matched.group(1) in on_disk:
+                hits[matched.group(1)] = hits.get(matched.group(1), 0) + 1
+        if hits:
+            pipe = get_redis().pipeline(transaction=False)
+            for manga_id, count in hits.items():
+                pipe.zincrby(FEED_HITS_KEY, count, manga_id)
+            pipe.execute()
+        return sum(hits.values())
+
+    def feed_path(self, feedtype, manga_id):
+        return os.path.join(self.root, feedtype, "manga", str(manga_id))
+
+    def write_file(self, path, data):
+        """
+        Write to a temporary file next to path and rename it into place, so nginx
+        never serves a half written feed
+        """
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(handle, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def remove_files(self, manga_id):
+        """
+        Drop the files for a manga so requests fall through to the app again
+        """
+        for feedtype in FEED_TYPES:
+            try:
+                os.unlink(self.feed_path(feedtype, manga_id))
+            except FileNotFoundError:
+                pass
+        self.exported.pop(str(manga_id), None)
+
+    def resolve(self, manga_id):
+        """
+        Returns the UUID for a stored ID, converting legacy IDs through the API once
+        """
+        uuid = parse_manga_id(manga_id)
+        if isinstance(uuid, int):
+            if uuid not in self.resolved:
+                new_uuid = self.rss.convert_legacy_id(uuid)
+                if new_uuid is None:
+                    return None
+                self.resolved[uuid] = new_uuid
+            uuid = self.resolved[uuid]
+        return uuid
+
+    def api_calls_needed(self, manga_id):
+        """
+        How many calls exporting manga_id would make to the API, anything
+        still in the cache is free
+        """
+        uuid = parse_manga_id(manga_id)
+        if uuid is None:
+            return 0
+        if isinstance(uuid, int):
+            if uuid not in self.resolved:
+                # The mapping, and we can't know about the rest without it
+                return 3
+            uuid = self.resolved[uuid]
+        # The chapter list is always fetched, the manga only when it's not cached
+        return 1 + (0 if type(self.rss).make_request.is_cached(self.rss.manga_uri(uuid)) else 1)
+
+    def export(self, manga_id):
+        """
+        Regenerate the files for a manga if its data changed since we last wrote them.
+        Returns True if anything was written.
+        """
+        uuid = self.resolve(manga_id)
+        if uuid is None:
+            self.logger.warning("Can't export {}, not a valid manga ID".format(manga_id))
+            self.remove_files(manga_id)
+            return False
+        manga = self.rss.get_manga(uuid)
+        # Nginx serves these feeds, so nothing else keeps their chapters fresh in the
+        # cache. Skip it, otherwise a new chapter could wait out a whole TTL on top of
+        # the interval before it shows up.
+        chapters = type(self.rss).make_request.refresh(self.rss, self.rss.chapters_uri(uuid, ["en"]))
+        if manga is None or chapters is None:
+            self.logger.warning("Couldn't get data for {}, removing its files".format(manga_id))
+            self.remove_files(manga_id)
+            return False
+
+        digest = hashlib.sha1(json.dumps([manga, chapters], sort_keys=True).encode("utf-8")).hexdigest()
+        paths = {feedtype: self.feed_path(feedtype, manga_id) for feedtype in FEED_TYPES}
+        if self.exported.get(str(manga_id)) == digest and all(os.path.exists(x) for x in paths.values()):
+            self.logger.debug("{} hasn't changed, not exporting".format(manga_id))
+            return False
+        for feedtype, path in paths.items():
+            self.write_file(path, self.rss.build_feed(uuid, manga, chapters, feedtype=feedtype))
+        self.exported[str(manga_id)] = digest
+        self.logger.info("Exported feeds for {}".format(manga_id))
+        return True
+
+    def export_all(self, manga_ids, budget=None, tracked=(), max_lag=None):
+        """
+        Export the manga given, tracked ones first and then least recently checked,
+        without making more than budget calls to the API. Everything else shares the
+        same rate limit, so this shouldn't eat all of it.
+        Files for manga that haven't been checked for max_lag seconds are removed, so
+        nginx never serves a feed further behind than that. Returns how many were written.
+        """
+        written = 0
+        spent = 0
+        tracked = {str(x) for x in tracked}
+        # sorted() is stable, so ties (never checked) stay in the order given
+        for manga_id in sorted(manga_ids, key=lambda x: (str(x) not in tracked, self.last_checked.get(str(x), 0))):
+            try:
+                cost = self.api_calls_needed(manga_id)
+                if budget is not None and cost and spent + cost > budget:
+                    continue
+                spent += cost
+                self.last_checked[str(manga_id)] = time.time()
+                if self.export(manga_id):
+                    written += 1
+            except Exception as exc: # pylint: disable=broad-except
+                # One bad manga shouldn't stop the rest from being exported, and
+                # shouldn't leave a feed on disk that nothing can update
+                self.logger.exception("Failed to export feeds for {}: {}".format(manga_id, exc))
+                try:
+                    self.remove_files(manga_id)
+                except OSError:
+                    pass
+        self.logger.debug("Used {} of {} API calls".format(spent, budget))
+        if max_lag is not None:
+            for manga_id in self.files_on_disk():
+                # Files from before a restart count from when we started
+                if time.time() - self.last_checked.get(manga_id, self.started) > max_lag:
+                    self.logger.warning("{} hasn't been checked for over {}s, removing its files".format(manga_id, max_lag))
+                    self.remove_files(manga_id)
+        return written
@@ -35,6 +35,13 @@ class MDRSSFeed():
         manga = self.get_manga(manga_id)
         if manga is None or chapters is None:
             return None
+        return self.build_feed(manga_id, manga, chapters, feedtype=feedtype)
+
+    def build_feed(self, manga_id, manga, chapters, feedtype="rss"):
+        """
+        Turns the manga and chapter responses from the API into a feed,
+        so callers that already have them don't need to ask again
+        """
         feed = FeedGenerator()
         try:
             id_title = manga["data"]["attributes"]["title"]["en"]
@@ -105,14 +112,22 @@ class MDRSSFeed():
         """
         Let's get a Manga
         """
-        return self.make_request('manga/{}'.format(manga_id))
+        return self.make_request(self.manga_uri(manga_id))
 
     def get_recent_chapters(self, manga_id, language_filter):
         """
         Grab chapters for the Manga
         """
+        return self.make_request(self.chapters_uri(manga_id, language_filter))
+
+    @staticmethod
+    def manga_uri(manga_id):
+        return 'manga/{}'.format(manga_id)
+
+    @staticmethod
+    def chapters_uri(manga_id, language_filter):
         locale_filter = "&".join(["translatedLanguage[]={}".format(x) for x in language_filter])
-        return self.make_request('manga/{}/feed?order[chapter]=desc&{}'.format(manga_id, locale_filter))
+        return 'manga/{}/feed?order[chapter]=desc&{}'.format(manga_id, locale_filter)
 
 
     def convert_legacy_id(self, manga_id):
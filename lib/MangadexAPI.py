@@ -7,7 +7,6 @@ import json
 from uuid import UUID
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import base64
-from redis import StrictRedis
 import requests
 from lib.rcache import DistributedCache as rcache
 from lib.ratelimit import RateLimitDecorator as ratelimit
@@ -16,7 +15,6 @@ from lib.Manga import Manga
 
 logging.basicConfig(filename='/tmp/tmdfe.log', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG)
 module_logger = logging.getLogger('mdapi')
-REDIS = StrictRedis(host="localhost", decode_responses=True)
 
 class APIError(Exception):
     """
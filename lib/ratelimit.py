@@ -11,22 +11,38 @@ Modified to use redis for locking and timing
 # pylint: disable=line-too-long
 # pylint: disable=logging-format-interpolation
 # pylint: disable=missing-module-docstring
-import os
 from functools import wraps
 import time
-import threading
 import logging
-from redis import StrictRedis
-
-def now():
-    '''
-    Use monotonic time if available, otherwise fall back to the system clock.
-    :return: Time function.
-    :rtype: function
-    '''
-    if hasattr(time, 'monotonic'):
-        return time.monotonic
-    return time.time
+from lib.rconn import get_redis
+
+# Both keys share a hash tag so they land in the same slot on a Redis Cluster
+NUM_CALLS_KEY = "{rl}_numcalls"
+LAST_RESET_KEY = "{rl}_last_reset"
+
+# Resets the window if it has elapsed and counts the call, all in one round trip.
+# Running it as a script keeps it atomic without having to take a lock first, and
+# reading the time from redis means every host measures the window on the same clock.
+# KEYS: num_calls, last_reset  ARGV: period
+# Returns the new number of calls and the period remaining (as a string, Lua would
+# truncate a float)
+RATELIMIT_SCRIPT = '''
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local num_calls = tonumber(redis.call('GET', KEYS[1]))
+local last_reset = tonumber(redis.call('GET', KEYS[2]))
+local period_remaining = 0
+if last_reset then
+    period_remaining = tonumber(ARGV[1]) - (now - last_reset)
+end
+if num_calls == nil or period_remaining <= 0 then
+    num_calls = 0
+    redis.call('SET', KEYS[2], string.format('%.6f', now))
+end
+num_calls = num_calls + 1
+redis.call('SET', KEYS[1], num_calls)
+return {num_calls, tostring(period_remaining)}
+'''
 
 class RateLimitException(Exception):
     '''
@@ -47,7 +63,7 @@ class RateLimitDecorator():
     '''
     Rate limit decorator class.
     '''
-    def __init__(self, calls=15, period=900, clock=now(), raise_on_limit=True):
+    def __init__(self, calls=15, period=900, raise_on_limit=True):
         '''
         Instantiate a RateLimitDecorator with some sensible defaults. By
         default the Twitter rate limiting window is respected (15 calls every
@@ -55,42 +71,16 @@ class RateLimitDecorator():
 
         :param int calls: Maximum function invocations allowed within a time period.
         :param float period: An upper bound time period (in seconds) before the rate limit resets.
-        :param function clock: An optional function retuning the current time.
         :param bool raise_on_limit: A boolean allowing the caller to avoiding rasing an exception.
         '''
         self.logger = logging.getLogger('mdapi.ratelimit')
-        try:
-            redis_host = os.environ['REDIS_HOST']
-        except KeyError:
-            redis_host = "localhost"
-        self.__redis = StrictRedis(host=redis_host, decode_responses=True)
         self.clamped_calls = calls
         self.period = period
-        self.clock = clock
         self.raise_on_limit = raise_on_limit
 
-        # Initialise the decorator state.
-        self.last_reset = clock()
-        self.num_calls = 0
-
-        # Add thread safety.
-        self.lock = threading.RLock()
-
-    @property
-    def num_calls(self):
-        return int(self.__redis.get("rl_numcalls"))
-
-    @num_calls.setter
-    def num_calls(self, calls):
-        self.__redis.set("rl_numcalls", calls)
-
-    @property
-    def last_reset(self):
-        return float(self.__redis.get("rl_last_reset"))
-
-    @last_reset.setter
-    def last_reset(self, cur_clock):
-        self.__redis.set("rl_last_reset", cur_clock)
+        # The decorator state lives in redis and is only ever touched by the script,
+        # which is registered on first use so importing doesn't connect.
+        self.__script = None
 
     def __call__(self, func):
         '''
@@ -114,38 +104,33 @@ class RateLimitDecorator():
             :param kargs: keyworded variable length argument list to the decorated function.
             :raises: RateLimitException
             '''
-            with self.__redis.lock("ratelimit"):
-                period_remaining = self.__period_remaining()
-                self.logger.debug("period_remaining is {}".format(period_remaining))
-
-                # If the time window has elapsed then reset.
-                if period_remaining <= 0:
-                    self.num_calls = 0
-                    self.last_reset = self.clock()
-
-                # Increase the number of attempts to call the function.
-                self.num_calls += 1
-                self.logger.debug("Incremented num_calls to {}".format(self.num_calls))
-
-                # If the number of attempts to call the function exceeds the
-                # maximum then raise an exception.
-                if self.num_calls > self.clamped_calls:
-                    if self.raise_on_limit:
-                        raise RateLimitException('too many calls', period_remaining)
-                    return None
+            # Reset the window if it has elapsed and increase the number of
+            # attempts to call the function.
+            num_calls, period_remaining = self.__count_call()
+            self.logger.debug("period_remaining is {}".format(period_remaining))
+            self.logger.debug("Incremented num_calls to {}".format(num_calls))
+
+            # If the number of attempts to call the function exceeds the
+            # maximum then raise an exception.
+            if num_calls > self.clamped_calls:
+                if self.raise_on_limit:
+                    raise RateLimitException('too many calls', period_remaining)
+                return None
 
             return func(*args, **kargs)
         return wrapper
 
-    def __period_remaining(self):
+    def __count_call(self):
         '''
-        Return the period remaining for the current rate limit window.
+        Count a call against the shared window in a single round trip to redis.
 
-        :return: The remaing period.
-        :rtype: float
+        :return: The number of calls made in this window and the remaining period.
+        :rtype: tuple
         '''
-        elapsed = self.clock() - self.last_reset
-        return self.period - elapsed
+        if self.__script is None:
+            self.__script = get_redis().register_script(RATELIMIT_SCRIPT)
+        num_calls, period_remaining = self.__script(keys=[NUM_CALLS_KEY, LAST_RESET_KEY], args=[self.period])
+        return int(num_calls), float(period_remaining)
 
 def sleep_and_retry(func):
     '''
@@ -8,11 +8,26 @@ would run into errors since this *only* looks at the arguments and not the funct
 # pylint: disable=line-too-long
 # pylint: disable=logging-format-interpolation
 # pylint: disable=missing-module-docstring
-import os
+import re
 import logging
+import hashlib
 from functools import partial
 import json
-from redis import StrictRedis
+from lib.rconn import get_cache
+
+# Sorted set of call arguments (as JSON) -> number of times they were asked for.
+# Lives on the same node as the keys it counts, used to warm the cache back up.
+HITS_KEY = "cache_hits"
+# Most members HITS_KEY keeps, the least requested are dropped past this
+HITS_LIMIT = 20000
+
+# Only these get counted, they're what's worth warming back up. Searches go stale
+# too quickly and would crowd everything else out of HITS_KEY.
+TRACKED_CALLS = (
+    re.compile(r'^manga/[0-9a-fA-F-]+$'),        # Manga records
+    re.compile(r'^manga/[0-9a-fA-F-]+/feed\?'),  # Chapter lists
+    re.compile(r'^legacy/mapping$'),             # Legacy ID mappings
+)
 
 class DistributedCache():
     """
@@ -20,43 +35,100 @@ class DistributedCache():
     Also provides communication between workers
     """
     def __init__(self, function):
-        try:
-            redis_host = os.environ['REDIS_HOST']
-        except KeyError:
-            redis_host = "localhost"
-        self.__redis = StrictRedis(host=redis_host, decode_responses=True)
         self.logger = logging.getLogger('mdapi.redis')
         self.function = function
 
     def get(self, cache_key: str, rformat="json"):
-        if self.__redis.exists(cache_key):
-            self.logger.debug("Got {} from cache".format(cache_key))
-            if rformat == "json":
-                return json.loads(self.__redis.get(cache_key))
-            return self.__redis.get(cache_key)
-        self.logger.debug("{} not in cache".format(cache_key))
-        return None
+        # A single GET, a missing key just comes back as None
+        return self.decode(cache_key, get_cache(cache_key).get(cache_key), rformat=rformat)
+
+    def decode(self, cache_key: str, value, rformat="json"):
+        if value is None:
+            self.logger.debug("{} not in cache".format(cache_key))
+            return None
+        self.logger.debug("Got {} from cache".format(cache_key))
+        if rformat == "json":
+            return json.loads(value)
+        return value
 
     def set(self, cache_key: str, value: str, expire=300):
-        self.__redis.setex(cache_key, expire, value)
+        # Every distinct call (searches too) gets counted, so keep the counts from
+        # growing forever. Rides along with the SETEX, no extra round trip.
+        pipe = get_cache(cache_key).pipeline(transaction=False)
+        pipe.setex(cache_key, expire, value)
+        pipe.zremrangebyrank(HITS_KEY, 0, -HITS_LIMIT - 1)
+        pipe.execute()
         self.logger.debug("Put {} into cache with TTL of {}".format(cache_key, expire))
 
+    def is_cached(self, *args, **kwargs):
+        """
+        Whether a call with these arguments would be answered from the cache
+        """
+        cache_key = self.make_key(*args, **kwargs)
+        return bool(get_cache(cache_key).exists(cache_key))
+
+    def make_key(self, *args, **kwargs):
+        """
+        Builds the cache key from the arguments. This has to come out the same in every
+        worker (hash() doesn't, it's salted per process) and on every node we shard over.
+        """
+        key_string = str(args)+str(kwargs) if kwargs else str(args)
+        self.logger.debug("Cache key generated with string:{}".format(key_string))
+        return "cache:{}".format(hashlib.sha1(key_string.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def is_tracked(args):
+        """
+        Whether calls with these arguments get counted in HITS_KEY
+        """
+        return bool(args) and isinstance(args[0], str) and any(x.match(args[0]) for x in TRACKED_CALLS)
+
+    @staticmethod
+    def make_member(args, kwargs):
+        """
+        The arguments as they're stored in HITS_KEY, None if they can't be.
+        """
+        try:
+            return json.dumps([args, kwargs])
+        except TypeError:
+            return None
+
+    @staticmethod
+    def parse_member(member):
+        """
+        Reverse of make_member, gives back (args, kwargs) that make_key will
+        turn into the same cache key
+        """
+        args, kwargs = json.loads(member)
+        return tuple(args), kwargs
+
     def __call__(self, instance, *args, **kwargs):
         self.logger.debug("Called wrapper with {}, {}".format(args, kwargs))
-        if kwargs:
-            cache_key = hash(str(args)+str(kwargs))
-            self.logger.debug("Cache key generated with string:{}".format(str(args)+str(kwargs)))
-        else:
-            cache_key = hash(str(args))
-            self.logger.debug("Cache key generated with string:{}".format(str(args)))
+        cache_key = self.make_key(*args, **kwargs)
         self.logger.debug("Using cache key of {}".format(cache_key))
-        cached_value = self.get(cache_key)
+        member = self.make_member(args, kwargs) if self.is_tracked(args) else None
+        # Count the hit in the same round trip as the lookup
+        pipe = get_cache(cache_key).pipeline(transaction=False)
+        pipe.get(cache_key)
+        if member:
+            pipe.zincrby(HITS_KEY, 1, member)
+        cached_value = self.decode(cache_key, pipe.execute()[0])
         if cached_value:
             return cached_value
         response = self.function(instance, *args, **kwargs)
         self.set(cache_key, json.dumps(response))
         return response
 
+    def refresh(self, instance, *args, **kwargs):
+        """
+        Call the function whether or not it's cached and store what it returns.
+        If nothing comes back, whatever is already cached is left alone.
+        """
+        response = self.function(instance, *args, **kwargs)
+        if response is not None:
+            self.set(self.make_key(*args, **kwargs), json.dumps(response))
+        return response
+
     def __get__(self, instance, owner):
         if instance is None:
             return self
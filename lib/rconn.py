@@ -0,0 +1,121 @@
+"""
+Shared Redis connections.
+
+Everything that talks to Redis (the cache, the rate limiter) gets its client from here,
+so each worker process only ever holds one connection pool per Redis node instead of
+one StrictRedis per decorated method.
+
+Configured from the environment:
+    REDIS_HOST          Host of the primary Redis (default: localhost)
+    REDIS_PORT          Port of the primary Redis (default: 6379)
+    REDIS_SOCKET        Path to a unix socket, used instead of REDIS_HOST/REDIS_PORT
+    REDIS_CLUSTER       Set to 1 if REDIS_HOST:REDIS_PORT is a Redis Cluster
+    REDIS_CACHE_NODES   Comma separated redis:// or unix:// URLs to spread cached API
+                        responses over. Rate limit state always stays on the primary so
+                        every worker sees the same numbers.
+"""
+# pylint: disable=line-too-long
+# pylint: disable=logging-format-interpolation
+import os
+import hashlib
+import logging
+import threading
+from bisect import bisect
+from redis import StrictRedis, ConnectionPool, UnixDomainSocketConnection
+
+module_logger = logging.getLogger('mdapi.redis')
+
+_LOCK = threading.Lock()
+_PRIMARY = None
+_CACHE_RING = None
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+def _build_primary():
+    """
+    Build the client for the primary Redis, based on the environment
+    """
+    redis_host = os.environ.get('REDIS_HOST', "localhost")
+    redis_port = int(os.environ.get('REDIS_PORT', 6379))
+    if _env_flag('REDIS_CLUSTER'):
+        try:
+            from redis.cluster import RedisCluster # pylint: disable=import-outside-toplevel
+        except ImportError as import_error:
+            raise RuntimeError("REDIS_CLUSTER needs redis-py 4.1 or newer") from import_error
+        module_logger.info("Using Redis Cluster at {}:{}".format(redis_host, redis_port))
+        return RedisCluster(host=redis_host, port=redis_port, decode_responses=True)
+    socket_path = os.environ.get('REDIS_SOCKET')
+    if socket_path:
+        module_logger.info("Using Redis on unix socket {}".format(socket_path))
+        pool = ConnectionPool(connection_class=UnixDomainSocketConnection, path=socket_path, decode_responses=True)
+    else:
+        module_logger.info("Using Redis at {}:{}".format(redis_host, redis_port))
+        pool = ConnectionPool(host=redis_host, port=redis_port, decode_responses=True)
+    return StrictRedis(connection_pool=pool)
+
+class ConsistentHashRing():
+    """
+    Spreads keys over several Redis nodes. Every node gets a bunch of points on the ring,
+    so adding or dropping a node only moves the keys that landed next to its points.
+    """
+    def __init__(self, nodes, replicas=100):
+        """
+        :param dict nodes: Node name (usually the URL) to Redis client
+        :param int replicas: Number of points each node gets on the ring
+        """
+        self.nodes = dict(nodes)
+        self.ring = {}
+        for name in self.nodes:
+            for replica in range(replicas):
+                self.ring[self._hash("{}#{}".format(name, replica))] = name
+        self.points = sorted(self.ring)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """
+        Returns the client that owns key
+        """
+        index = bisect(self.points, self._hash(str(key))) % len(self.points)
+        return self.nodes[self.ring[self.points[index]]]
+
+def get_redis():
+    """
+    Returns the client for the primary Redis. Shared by everything in this process.
+    """
+    global _PRIMARY # pylint: disable=global-statement
+    if _PRIMARY is None:
+        with _LOCK:
+            if _PRIMARY is None:
+                _PRIMARY = _build_primary()
+    return _PRIMARY
+
+def _get_cache_ring():
+    global _CACHE_RING # pylint: disable=global-statement
+    if _CACHE_RING is None:
+        with _LOCK:
+            if _CACHE_RING is None:
+                urls = [x.strip() for x in os.environ.get('REDIS_CACHE_NODES', "").split(",") if x.strip()]
+                module_logger.info("Sharding cache over {}".format(urls))
+                _CACHE_RING = ConsistentHashRing({url: StrictRedis(connection_pool=ConnectionPool.from_url(url, decode_responses=True)) for url in urls})
+    return _CACHE_RING
+
+def get_cache(cache_key):
+    """
+    Returns the client that should hold cache_key. That's the primary, unless
+    REDIS_CACHE_NODES is set.
+    """
+    if not os.environ.get('REDIS_CACHE_NODES', "").strip():
+        return get_redis()
+    return _get_cache_ring().get_node(cache_key)
+
+def cache_nodes():
+    """
+    Returns every client cache keys can live on
+    """
+    if not os.environ.get('REDIS_CACHE_NODES', "").strip():
+        return [get_redis()]
+    return list(_get_cache_ring().nodes.values())
@@ -15,6 +15,8 @@ from lib.MangadexAPI import MangadexAPI, MangaNotFound
 # This is what actually generates the RSS feeds, should have no dependencies on the bare-bones
 # MangadexAPI above
 from lib.MDRSSFeed import MDRSSFeed
+# Counts feed requests so export_feeds.py knows which ones to write out for nginx
+from lib.FeedExporter import record_feed_hit
 
 app = Quart(__name__)
 app.secret_key = 'much secret very secure'
@@ -110,6 +112,9 @@ async def get_manga_rss(manga_id: Union[UUID, int]):
         feed_data = RSS.generate_feed(manga_id)
     if feed_data is None:
         abort(404)
+    if not request.args.get("lang"):
+        # Only the default feed gets exported
+        record_feed_hit(manga_id)
     return Response(feed_data, mimetype='text/xml')
 
 
@@ -126,6 +131,9 @@ async def get_manga_atom(manga_id: Union[UUID, int]):
         feed_data = RSS.generate_feed(manga_id, feedtype="atom")
     if feed_data is None:
         abort(404)
+    if not request.args.get("lang"):
+        # Only the default feed gets exported
+        record_feed_hit(manga_id)
     return Response(feed_data, mimetype='text/xml')
 
 def get_pagination(**kwargs):
@@ -0,0 +1,80 @@
+# pylint: disable=line-too-long
+# pylint: disable=logging-format-interpolation
+"""
+Keeps the redis cache warm across flushes and restarts.
+
+    python warm_cache.py snapshot     Save the most requested cache entries to disk
+    python warm_cache.py restore      Load them back, then refetch whatever went stale
+    python warm_cache.py run          Snapshot every --every seconds, restoring first
+                                      whenever redis has been flushed or restarted
+
+Restoring never overwrites anything already in redis, so it's safe to run
+against a cache that's already serving.
+"""
+import argparse
+import logging
+import threading
+import time
+from lib.MDRSSFeed import MDRSSFeed
+from lib.CacheSnapshot import CacheSnapshot
+
+API_URL = "https://api.mangadex.org"
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot and restore the redis cache")
+    parser.add_argument("command", choices=["snapshot", "restore", "run"])
+    parser.add_argument("--file", default="cache_snapshot.json.gz", help="Snapshot file (default: cache_snapshot.json.gz)")
+    parser.add_argument("--keep", type=int, default=5000, help="How many of the most requested entries to save (default: 5000)")
+    parser.add_argument("--grace", type=int, default=3600, help="Seconds to keep serving stale restored entries while they're refetched (default: 3600)")
+    parser.add_argument("--max-age", type=int, default=21600, help="Don't serve anything from a snapshot older than this many seconds, just refetch it (default: 21600)")
+    parser.add_argument("--no-refresh", action="store_true", help="Don't refetch stale entries after restoring")
+    parser.add_argument("--rate", type=float, default=1.0, help="Most API calls a second to spend refetching stale entries (default: 1, the API allows 5)")
+    parser.add_argument("--every", type=int, default=300, help="Seconds between snapshots for run (default: 300)")
+    parser.add_argument("--check-every", type=int, default=5, help="Seconds between checks for a flushed redis for run (default: 5)")
+    parser.add_argument("--force", action="store_true", help="Write the snapshot even if it's much smaller than the one on disk")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG if args.verbose else logging.INFO)
+    snapshot = CacheSnapshot(MDRSSFeed(API_URL), args.file)
+
+    if args.command == "snapshot":
+        snapshot.snapshot(keep=args.keep, force=args.force)
+        return
+
+    if args.command == "restore":
+        stale = snapshot.restore(grace=args.grace, max_age=args.max_age)
+        if not args.no_refresh:
+            snapshot.refresh(stale, rate=args.rate)
+        return
+
+    # run: restore whenever redis comes back empty (including when we first start),
+    # and snapshot every --every seconds otherwise
+    logger = logging.getLogger('mdapi.snapshot')
+    last_snapshot = time.monotonic()
+    refresher = None
+    stop_refresh = threading.Event()
+    while True:
+        try:
+            if snapshot.is_flushed():
+                logger.warning("Redis has been flushed or restarted, restoring from {}".format(args.file))
+                stale = snapshot.restore(grace=args.grace, max_age=args.max_age)
+                if not args.no_refresh:
+                    # Only ever one refresh at a time, the new list replaces what's left of the old one
+                    if refresher is not None and refresher.is_alive():
+                        stop_refresh.set()
+                        refresher.join()
+                    stop_refresh = threading.Event()
+                    # Refetch in the background so we keep watching meanwhile
+                    refresher = threading.Thread(target=snapshot.refresh, args=(stale,), kwargs={"rate": args.rate, "stop": stop_refresh}, daemon=True)
+                    refresher.start()
+            elif time.monotonic() - last_snapshot >= args.every:
+                last_snapshot = time.monotonic()
+                snapshot.snapshot(keep=args.keep, force=args.force)
+        except Exception: # pylint: disable=broad-except
+            # Redis going away for a bit shouldn't stop us, that's when we're needed
+            logger.exception("Cache warmer run failed, trying again in {}s".format(args.check_every))
+        time.sleep(args.check_every)
+
+if __name__ == "__main__":
+    main()